@@ -1,7 +1,13 @@
-import os, json, logging
+import os, asyncio, logging, queue
+import orjson
+import pymongo
+from logging.handlers import QueueHandler, QueueListener
 from motor.motor_asyncio import AsyncIOMotorClient
+from bson import ObjectId
+from pymongo import WriteConcern
+from pymongo.errors import BulkWriteError
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from datetime import datetime
 
 # Logging setup
@@ -11,6 +17,50 @@ handler = logging.StreamHandler()
 handler.setFormatter(logging.Formatter("%(message)s"))
 logger.addHandler(handler)
 
+# Kubernetes probes hit these every few seconds; keep them out of the
+# uvicorn access log. Access records carry (client, method, path, version,
+# status) as args, where path is root_path + path + "?query". The root path
+# is read from UVICORN_ROOT_PATH (uvicorn's env form of --root-path), so set
+# it there rather than on the command line when serving under a prefix.
+_ROOT_PATH = os.getenv("UVICORN_ROOT_PATH", "").rstrip("/")
+_SKIP_PATHS = frozenset(_ROOT_PATH + path for path in ("/healthz", "/ready"))
+
+class ProbeFilter(logging.Filter):
+    def filter(self, record):
+        args = record.args
+        if not (isinstance(args, tuple) and len(args) > 2 and isinstance(args[2], str)):
+            return True
+        path = args[2].partition("?")[0]
+        return (path[:-1] if path.endswith("/") else path) not in _SKIP_PATHS
+
+logging.getLogger("uvicorn.access").addFilter(ProbeFilter())
+
+class AccessQueueHandler(QueueHandler):
+    # Hand the record over untouched: uvicorn's AccessFormatter needs the
+    # original args, which QueueHandler.prepare() would flatten.
+    def prepare(self, record):
+        return record
+
+def start_access_log_queue():
+    # uvicorn.access writes one line per request; move those writes to a
+    # listener thread so the event loop never blocks on the stream.
+    access_logger = logging.getLogger("uvicorn.access")
+    handlers = access_logger.handlers[:]
+    if not handlers:
+        return None
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    access_logger.handlers = [AccessQueueHandler(log_queue)]
+    return listener, handlers
+
+def stop_access_log_queue(state):
+    # Restore the direct handlers first so no record lands in the queue
+    # after the listener has drained it.
+    listener, handlers = state
+    logging.getLogger("uvicorn.access").handlers = handlers
+    listener.stop()
+
 # Config from environment
 USERNAME          = os.getenv("MONGODB_USERNAME")
 PASSWORD          = os.getenv("MONGODB_PASSWORD")
@@ -19,6 +69,25 @@ PORT              = os.getenv("MONGODB_PORT")
 QUERY_PARAMS      = os.getenv("MONGO_QUERY_PARAMS")
 MONGO_DB          = os.getenv("MONGO_DB")
 MONGO_COLLECTION  = os.getenv("MONGO_COLLECTION")
+WORKERS           = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+# Each worker process has its own pool; split the budget so Mongo sees
+# roughly 100 connections in total rather than 100 per worker.
+MAX_POOL_SIZE     = int(os.getenv("MONGO_MAX_POOL_SIZE", str(max(4, 100 // WORKERS))))
+MIN_POOL_SIZE     = int(os.getenv("MONGO_MIN_POOL_SIZE", str(min(8, MAX_POOL_SIZE))))
+SERVER_TIMEOUT_MS = 3000
+# Motor runs every driver call on one shared thread pool of this size
+# (its own default), so concurrency limits below are sized against it.
+MOTOR_THREADS     = int(os.getenv("MOTOR_MAX_WORKERS", str((os.cpu_count() or 1) * 5)))
+PING_INTERVAL_S   = 2
+# The ping's deadline starts before it waits for a free Motor executor
+# thread, so leave room for queueing under write load.
+PING_TIMEOUT_S    = 2
+LIVENESS_FAILURES = 3
+BATCH_MAX_ORDERS  = 500
+BATCH_WINDOW_S    = 0.005
+BATCH_WRITERS     = max(1, min(MAX_POOL_SIZE, MOTOR_THREADS) // 2)
+ORDER_QUEUE_MAX   = 5000
+UNACKED_WRITES    = max(1, MOTOR_THREADS // 4)
 
 # Build Mongo URI dynamically (without TLS)
 MONGO_URI = f"mongodb://{USERNAME}:{PASSWORD}@{HOST}:{PORT}/"
@@ -26,55 +95,212 @@ if QUERY_PARAMS:
     MONGO_URI += f"?{QUERY_PARAMS}"
 
 app = FastAPI()
+app.state.orders = None
+app.state.orders_w0 = None
+app.state.mongo_ok = False
+app.state.mongo_error = "Mongo client not ready"
+app.state.ping_failures = LIVENESS_FAILURES
 mongo_client: AsyncIOMotorClient | None = None
+# Created in startup_event so they bind to the running event loop.
+order_queue: asyncio.Queue | None = None
+write_slots: asyncio.Semaphore | None = None
+batch_writes: set[asyncio.Task] = set()
+unacked_writes: set[asyncio.Future] = set()
+
+def set_mongo_status(error: Exception | None = None):
+    # /ready follows the latest ping; /healthz only fails after
+    # LIVENESS_FAILURES pings in a row so a slow ping under load does not
+    # get the pod restarted.
+    app.state.mongo_ok = error is None
+    app.state.ping_failures = 0 if error is None else app.state.ping_failures + 1
+    app.state.mongo_error = None if error is None else (str(error) or type(error).__name__)
+
+async def ping_loop():
+    # Probes read the cached status instead of pinging Mongo on every hit.
+    while True:
+        await asyncio.sleep(PING_INTERVAL_S)
+        try:
+            # pymongo.timeout bounds the driver call on Motor's executor
+            # thread too; asyncio.wait_for would only abandon the future.
+            with pymongo.timeout(PING_TIMEOUT_S):
+                await mongo_client.admin.command("ping")
+            set_mongo_status()
+        except Exception as e:
+            set_mongo_status(e)
+
+async def order_writer():
+    # Concurrent POST /orders calls are grouped into one insert_many
+    # round-trip; each caller waits on its own future for the inserted id.
+    # Up to BATCH_WRITERS batches are written at once, leaving at least half
+    # of Motor's threads for reads, the health ping and w=0 inserts.
+    while True:
+        batch = [await order_queue.get()]
+        await asyncio.sleep(BATCH_WINDOW_S)
+        while len(batch) < BATCH_MAX_ORDERS and not order_queue.empty():
+            batch.append(order_queue.get_nowait())
+        await write_slots.acquire()
+        task = asyncio.create_task(write_batch(batch))
+        batch_writes.add(task)
+        task.add_done_callback(batch_writes.discard)
+
+async def write_batch(batch):
+    try:
+        await write_orders(batch)
+    finally:
+        write_slots.release()
+        for _ in batch:
+            order_queue.task_done()
+
+async def write_orders(batch):
+    docs = [doc for doc, _ in batch]
+    failed = {}
+    try:
+        await get_collection().insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        failed = {err["index"]: e for err in e.details.get("writeErrors", [])}
+        failed = failed or dict.fromkeys(range(len(batch)), e)
+    except Exception as e:
+        failed = dict.fromkeys(range(len(batch)), e)
+    for i, (doc, fut) in enumerate(batch):
+        if fut.done():
+            continue
+        if i in failed:
+            fut.set_exception(failed[i])
+        else:
+            fut.set_result(doc["_id"])
 
 @app.on_event("startup")
 async def startup_event():
-    global mongo_client
+    global mongo_client, order_queue, write_slots
+    # The client must be created here, after uvicorn forks its workers and
+    # starts the event loop, never at import time; one per process.
+    if mongo_client is not None:
+        raise RuntimeError("AsyncIOMotorClient already created in this process")
+    order_queue = asyncio.Queue(maxsize=ORDER_QUEUE_MAX)
+    write_slots = asyncio.Semaphore(BATCH_WRITERS)
+    # minPoolSize makes the driver open connections in the background; the
+    # ping below waits for the first one so the pool is seeded before traffic.
     mongo_client = AsyncIOMotorClient(
         MONGO_URI,
-        serverSelectionTimeoutMS=5000
+        minPoolSize=MIN_POOL_SIZE,
+        maxPoolSize=MAX_POOL_SIZE,
+        serverSelectionTimeoutMS=SERVER_TIMEOUT_MS,
+        w=1,
+        journal=False
     )
+    # Swap the access-log handlers only once the client is built; the
+    # constructor raises on bad URIs or pool settings.
+    app.state.access_log = start_access_log_queue()
 
     try:
         await mongo_client.admin.command("ping")
-        logger.info(json.dumps({"msg": "MongoDB connected successfully"}))
+        app.state.orders = mongo_client[MONGO_DB][MONGO_COLLECTION]
+        app.state.orders_w0 = app.state.orders.with_options(write_concern=WriteConcern(w=0))
+        set_mongo_status()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(orjson.dumps({"msg": "MongoDB connected successfully"}).decode())
     except Exception as e:
-        logger.error(json.dumps({"msg": "MongoDB connection failed", "error": str(e)}))
+        set_mongo_status(e)
+        if logger.isEnabledFor(logging.ERROR):
+            logger.error(orjson.dumps({"msg": "MongoDB connection failed", "error": str(e)}).decode())
+    app.state.ping_task = asyncio.create_task(ping_loop())
+    app.state.order_writer = asyncio.create_task(order_writer())
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    global mongo_client
+    app.state.ping_task.cancel()
+    await order_queue.join()
+    app.state.order_writer.cancel()
+    app.state.orders = None
+    app.state.orders_w0 = None
+    set_mongo_status(RuntimeError("Mongo client closed"))
+    await asyncio.gather(*unacked_writes, return_exceptions=True)
     if mongo_client:
         mongo_client.close()
+        mongo_client = None
+    if app.state.access_log:
+        stop_access_log_queue(app.state.access_log)
+        app.state.access_log = None
 
 class OrderIn(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     orderId: str
 
 def get_collection():
+    # Resolved once at startup; fall back to a fresh lookup if the initial
+    # ping failed and the client connected later.
+    if app.state.orders is not None:
+        return app.state.orders
     if not mongo_client:
         raise HTTPException(status_code=503, detail="Mongo client not ready")
     return mongo_client[MONGO_DB][MONGO_COLLECTION]
 
 @app.post("/orders")
 async def create_order(order: OrderIn):
-    res = await get_collection().insert_one({
+    fut = asyncio.get_running_loop().create_future()
+    await order_queue.put(({
+        "orderId": order.orderId,
+        "ts": datetime.utcnow().isoformat() + "Z"
+    }, fut))
+    inserted_id = await fut
+    return {"inserted": True, "id": inserted_id.binary.hex()}
+
+def unacked_write_done(fut):
+    unacked_writes.discard(fut)
+    if fut.cancelled() or fut.exception() is None:
+        return
+    if logger.isEnabledFor(logging.ERROR):
+        logger.error(orjson.dumps({"msg": "Unacknowledged insert failed", "error": str(fut.exception())}).decode())
+
+@app.post("/orders/async")
+async def create_order_async(order: OrderIn):
+    # Fire-and-forget for clients that do not need durability: the _id is
+    # generated here and the w=0 insert is not awaited. Each pending insert
+    # holds a Motor executor thread, so refuse new ones past UNACKED_WRITES
+    # or while Mongo is down rather than queueing them.
+    if not app.state.mongo_ok:
+        raise HTTPException(status_code=503, detail=app.state.mongo_error)
+    if len(unacked_writes) >= UNACKED_WRITES:
+        raise HTTPException(status_code=503, detail="Too many unacknowledged writes in flight")
+    coll = app.state.orders_w0
+    if coll is None:
+        coll = get_collection().with_options(write_concern=WriteConcern(w=0))
+    doc = {
+        "_id": ObjectId(),
         "orderId": order.orderId,
         "ts": datetime.utcnow().isoformat() + "Z"
-    })
-    return {"inserted": True, "id": str(res.inserted_id)}
+    }
+    fut = asyncio.ensure_future(coll.insert_one(doc))
+    unacked_writes.add(fut)
+    fut.add_done_callback(unacked_write_done)
+    return {"inserted": True, "id": doc["_id"].binary.hex()}
+
+@app.post("/orders/flush")
+async def flush_orders():
+    await order_queue.join()
+    return {"flushed": True}
 
 @app.get("/orders/count")
 async def count_orders():
+    # Read from collection metadata; may lag briefly after writes or an
+    # unclean shutdown. Use /orders/count_exact when an exact value matters.
+    return {"count": await get_collection().estimated_document_count()}
+
+@app.get("/orders/count_exact")
+async def count_orders_exact():
     return {"count": await get_collection().count_documents({})}
 
+def mongo_status(ok: bool):
+    if not ok:
+        raise HTTPException(status_code=503, detail=app.state.mongo_error)
+    return {"status": "ok"}
+
 @app.get("/healthz")
 async def health():
-    try:
-        await mongo_client.admin.command("ping")
-        return {"status": "ok"}
-    except Exception as e:
-        raise HTTPException(status_code=503, detail=str(e))
+    return mongo_status(app.state.ping_failures < LIVENESS_FAILURES)
 
 @app.get("/ready")
 async def ready():
-    return await health()
+    return mongo_status(app.state.mongo_ok)
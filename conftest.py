@@ -0,0 +1 @@
+# Lets plain `pytest` import app.py from the repository root.
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import queue
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo.errors import BulkWriteError
+
+import app
+
+
+class FakeCollection:
+    def __init__(self, error=None):
+        self.error = error
+        self.docs = None
+
+    async def insert_many(self, docs, ordered=True):
+        self.docs = docs
+        for doc in docs:
+            doc.setdefault("_id", ObjectId())
+        if self.error:
+            raise self.error
+
+
+def run_batch(coll, n):
+    async def go():
+        loop = asyncio.get_running_loop()
+        batch = [({"orderId": str(i)}, loop.create_future()) for i in range(n)]
+        app.app.state.orders = coll
+        try:
+            await app.write_orders(batch)
+        finally:
+            app.app.state.orders = None
+        return batch
+    return asyncio.run(go())
+
+
+def test_write_orders_resolves_inserted_ids():
+    coll = FakeCollection()
+    batch = run_batch(coll, 3)
+    assert [fut.result() for _, fut in batch] == [doc["_id"] for doc in coll.docs]
+
+
+def test_write_orders_fails_only_the_rejected_documents():
+    error = BulkWriteError({
+        "writeErrors": [{"index": 1, "code": 11000, "errmsg": "duplicate key"}],
+        "writeConcernErrors": [],
+        "nInserted": 2,
+    })
+    coll = FakeCollection(error)
+    batch = run_batch(coll, 3)
+    assert batch[0][1].result() == coll.docs[0]["_id"]
+    assert batch[1][1].exception() is error
+    assert batch[2][1].result() == coll.docs[2]["_id"]
+
+
+def test_write_orders_fails_whole_batch_on_write_concern_error():
+    error = BulkWriteError({
+        "writeErrors": [],
+        "writeConcernErrors": [{"code": 64, "errmsg": "waiting for replication timed out"}],
+        "nInserted": 2,
+    })
+    batch = run_batch(FakeCollection(error), 2)
+    assert all(fut.exception() is error for _, fut in batch)
+
+
+def test_write_orders_fails_whole_batch_on_other_errors():
+    error = RuntimeError("connection reset")
+    batch = run_batch(FakeCollection(error), 2)
+    for _, fut in batch:
+        with pytest.raises(RuntimeError):
+            fut.result()
+
+
+@pytest.mark.parametrize("path, logged", [
+    ("/healthz", False),
+    ("/healthz?probe=1", False),
+    ("/healthz/", False),
+    ("/ready", False),
+    ("/orders", True),
+    ("/orders/ready", True),
+    ("/admin/healthz", True),
+    ("/orders/count?next=/healthz", True),
+])
+def test_probe_filter(path, logged):
+    assert app.ProbeFilter().filter(access_record(path)) is logged
+
+
+def test_probe_filter_with_root_path(monkeypatch):
+    monkeypatch.setattr(app, "_SKIP_PATHS", frozenset({"/api/healthz", "/api/ready"}))
+    assert app.ProbeFilter().filter(access_record("/api/healthz?probe=1")) is False
+    assert app.ProbeFilter().filter(access_record("/healthz")) is True
+
+
+def access_record(path="/orders", status=200):
+    return logging.LogRecord(
+        "uvicorn.access", logging.INFO, __file__, 0,
+        '%s - "%s %s HTTP/%s" %d', ("127.0.0.1:5000", "GET", path, "1.1", status), None,
+    )
+
+
+def test_access_queue_handler_keeps_record_args():
+    from uvicorn.logging import AccessFormatter
+
+    log_queue = queue.SimpleQueue()
+    app.AccessQueueHandler(log_queue).handle(access_record(status=201))
+    line = AccessFormatter('%(status_code)s', use_colors=False).format(log_queue.get_nowait())
+    assert line == "201 Created"
+
+
+def test_startup_failure_leaves_access_handlers_in_place(monkeypatch):
+    access_logger = logging.getLogger("uvicorn.access")
+    original = logging.StreamHandler()
+    monkeypatch.setattr(access_logger, "handlers", [original])
+    monkeypatch.setattr(app, "MONGO_URI", "mongodb://localhost:27017/")
+    monkeypatch.setattr(app, "MIN_POOL_SIZE", app.MAX_POOL_SIZE + 1)
+    with pytest.raises(ValueError):
+        asyncio.run(app.startup_event())
+    assert access_logger.handlers == [original]
+
+
+def test_liveness_tolerates_isolated_ping_failures(monkeypatch):
+    monkeypatch.setattr(app.app, "state", type(app.app.state)())
+    app.set_mongo_status()
+    for _ in range(app.LIVENESS_FAILURES - 1):
+        app.set_mongo_status(TimeoutError("ping timed out"))
+    with pytest.raises(HTTPException):
+        asyncio.run(app.ready())
+    assert asyncio.run(app.health()) == {"status": "ok"}
+    app.set_mongo_status(TimeoutError("ping timed out"))
+    with pytest.raises(HTTPException):
+        asyncio.run(app.health())
+
+
+class RecordingCollection(FakeCollection):
+    def __init__(self, error=None):
+        super().__init__(error)
+        self.batches = []
+
+    async def insert_many(self, docs, ordered=True):
+        self.batches.append(len(docs))
+        await asyncio.sleep(0)
+        return await super().insert_many(docs, ordered)
+
+
+def use_collection(monkeypatch, coll, maxsize=app.ORDER_QUEUE_MAX):
+    monkeypatch.setattr(app.app.state, "orders", coll)
+    monkeypatch.setattr(app, "order_queue", asyncio.Queue(maxsize=maxsize))
+    monkeypatch.setattr(app, "write_slots", asyncio.Semaphore(app.BATCH_WRITERS))
+
+
+def start_writer(monkeypatch, coll):
+    use_collection(monkeypatch, coll)
+    return asyncio.create_task(app.order_writer())
+
+
+def place_orders(n):
+    return [asyncio.create_task(app.create_order(app.OrderIn(orderId=str(i)))) for i in range(n)]
+
+
+def test_order_writer_groups_concurrent_orders(monkeypatch):
+    async def go():
+        coll = RecordingCollection()
+        writer = start_writer(monkeypatch, coll)
+        results = await asyncio.gather(*place_orders(3000))
+        assert await app.flush_orders() == {"flushed": True}
+        writer.cancel()
+        return coll, results
+    coll, results = asyncio.run(go())
+    assert coll.batches == [app.BATCH_MAX_ORDERS] * 6
+    assert len({r["id"] for r in results}) == 3000
+
+
+def test_order_writer_releases_slots_when_a_batch_fails(monkeypatch):
+    async def go():
+        writer = start_writer(monkeypatch, RecordingCollection(RuntimeError("connection reset")))
+        results = await asyncio.gather(*place_orders(3), return_exceptions=True)
+        await asyncio.wait_for(app.order_queue.join(), 1)
+        writer.cancel()
+        for _ in range(app.BATCH_WRITERS):
+            await asyncio.wait_for(app.write_slots.acquire(), 1)
+        return results
+    results = asyncio.run(go())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_full_order_queue_holds_callers_until_drained(monkeypatch):
+    async def go():
+        coll = RecordingCollection()
+        use_collection(monkeypatch, coll, maxsize=2)
+        orders = place_orders(3)
+        await asyncio.sleep(0.01)
+        assert app.order_queue.full() and not any(t.done() for t in orders)
+        writer = asyncio.create_task(app.order_writer())
+        await asyncio.wait_for(asyncio.gather(*orders), 1)
+        writer.cancel()
+        return coll
+    coll = asyncio.run(go())
+    assert sum(coll.batches) == 3
+
+
+class BlockingCollection:
+    def __init__(self):
+        self.release = asyncio.Event()
+
+    async def insert_one(self, doc):
+        await self.release.wait()
+
+
+def test_create_order_async_refuses_when_mongo_is_down(monkeypatch):
+    monkeypatch.setattr(app.app.state, "mongo_ok", False)
+    monkeypatch.setattr(app.app.state, "mongo_error", "no servers")
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(app.create_order_async(app.OrderIn(orderId="1")))
+    assert exc.value.status_code == 503
+
+
+def test_create_order_async_caps_inflight_writes(monkeypatch):
+    async def go():
+        coll = BlockingCollection()
+        monkeypatch.setattr(app.app.state, "mongo_ok", True)
+        monkeypatch.setattr(app.app.state, "orders_w0", coll)
+        for i in range(app.UNACKED_WRITES):
+            assert (await app.create_order_async(app.OrderIn(orderId=str(i))))["inserted"]
+        with pytest.raises(HTTPException) as exc:
+            await app.create_order_async(app.OrderIn(orderId="over"))
+        coll.release.set()
+        await asyncio.gather(*app.unacked_writes)
+        return exc.value.status_code
+    assert asyncio.run(go()) == 503
+    assert not app.unacked_writes